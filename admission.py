@@ -0,0 +1,183 @@
+'''
+Admission control for the LLM-backed routes.
+
+Every call into Azure OpenAI goes through an AdmissionController, which
+- gives each user (get_user_sub()) a token bucket, so one user clicking
+  "Regenerate" over and over cannot burn the whole OpenAI quota,
+- caps the number of OpenAI calls in flight across the whole worker,
+- queues callers when the cap is reached and hands free slots to the
+  waiting users in round-robin order, so a busy user cannot starve others,
+- rejects straight away with a retry-after hint when the queues are full.
+
+All state lives in the worker process. app.py gives each worker its share of
+the deployment-wide limits. A worker only runs several OpenAI calls at once,
+and so only ever queues, when it serves requests on several threads
+(gunicorn --threads). With sync workers each worker handles one request at a
+time and only the token bucket applies. See the README.
+'''
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+BUCKET_PRUNE_INTERVAL = 60  # Seconds between sweeps of idle token buckets
+
+
+class AdmissionRejected(Exception):
+    '''Raised when a request is not admitted. retry_after is in seconds.'''
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate    # tokens added per second
+        self.burst = burst  # bucket size
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self):
+        '''Takes one token. Returns 0 on success, otherwise the seconds until a token is available.'''
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated_at) * self.rate >= self.burst
+
+
+class _Waiter:
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+
+
+class AdmissionController:
+    def __init__(self, max_concurrency, rate_per_user, burst_per_user,
+                 max_queue_per_user, max_queue_total, max_wait):
+        self.max_concurrency = max_concurrency
+        self.rate_per_user = rate_per_user
+        self.burst_per_user = burst_per_user
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue_total = max_queue_total
+        self.max_wait = max_wait
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._queues = OrderedDict()  # user_id -> deque of waiters, in round-robin order
+        self._buckets = {}
+        self._buckets_pruned_at = time.monotonic()
+
+        # Metrics, read through stats()
+        self._admitted = 0
+        self._rejected = {'rate_limited': 0, 'queue_full': 0, 'timeout': 0}
+        self._max_queue_depth = 0
+        self._wait_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def acquire(self, user_id):
+        started = time.monotonic()
+        with self._lock:
+            self._prune_buckets(started)
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(self.rate_per_user, self.burst_per_user)
+            retry_after = bucket.take()
+            if retry_after:
+                self._rejected['rate_limited'] += 1
+                raise AdmissionRejected('rate_limited', retry_after)
+
+            if self._active < self.max_concurrency and not self._queued:
+                self._active += 1
+                self._record_admitted(0.0)
+                return
+
+            user_queue = self._queues.get(user_id, ())
+            if len(user_queue) >= self.max_queue_per_user or self._queued >= self.max_queue_total:
+                bucket.refund()
+                self._rejected['queue_full'] += 1
+                raise AdmissionRejected('queue_full', self.max_wait)
+
+            waiter = _Waiter()
+            self._queues.setdefault(user_id, deque()).append(waiter)
+            self._queued += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queued)
+
+        waiter.event.wait(self.max_wait)
+
+        with self._lock:
+            if not waiter.granted:
+                # Timed out, leave the queue. release() may still grant us the
+                # slot between the wait returning and taking the lock, hence
+                # the granted flag rather than the event result.
+                user_queue = self._queues[user_id]
+                user_queue.remove(waiter)
+                if not user_queue:
+                    del self._queues[user_id]
+                self._queued -= 1
+                bucket.refund()
+                self._rejected['timeout'] += 1
+                raise AdmissionRejected('timeout', self.max_wait)
+            self._record_admitted(time.monotonic() - started)
+
+    def release(self):
+        with self._lock:
+            if not self._queued:
+                self._active -= 1
+                return
+            # Hand the slot straight to the next user in line (round robin),
+            # so _active stays the same.
+            user_id, user_queue = self._queues.popitem(last=False)
+            waiter = user_queue.popleft()
+            if user_queue:
+                self._queues[user_id] = user_queue
+            self._queued -= 1
+            waiter.granted = True
+            waiter.event.set()
+
+    @contextmanager
+    def admit(self, user_id):
+        self.acquire(user_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _prune_buckets(self, now):
+        # A full bucket behaves exactly like a new one, so it can be dropped
+        if now - self._buckets_pruned_at < BUCKET_PRUNE_INTERVAL:
+            return
+        self._buckets_pruned_at = now
+        for user_id in [user_id for user_id, bucket in self._buckets.items() if bucket.is_full(now)]:
+            del self._buckets[user_id]
+
+    def _record_admitted(self, waited):
+        self._admitted += 1
+        self._wait_count += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'active': self._active,
+                'max_concurrency': self.max_concurrency,
+                'queue_depth': self._queued,
+                'max_queue_depth': self._max_queue_depth,
+                'queued_users': len(self._queues),
+                'admitted': self._admitted,
+                'rejected': dict(self._rejected),
+                'wait_avg_seconds': self._wait_total / self._wait_count if self._wait_count else 0.0,
+                'wait_max_seconds': self._wait_max,
+            }
@@ -1,6 +1,6 @@
 import uuid
 import requests
-from flask import Flask, render_template, session, request, redirect, url_for, has_request_context, jsonify
+from flask import Flask, render_template, session, request, redirect, url_for, has_request_context, jsonify, send_from_directory
 from flask_session import Session  # https://pythonhosted.org/Flask-Session
 import msal
 import app_config
@@ -10,10 +10,15 @@ import openai
 import copy
 from datetime import datetime
 
-from azure.cosmos import CosmosClient, exceptions
+from azure.cosmos import CosmosClient, documents, exceptions
 
 import stripe
 
+from admission import AdmissionController, AdmissionRejected
+import static_assets
+from cosmos_access import CosmosAccess, CosmosThrottled, PRIORITY_HIGH, PRIORITY_LOW
+from profiling import RequestProfiler
+
 from dotenv import load_dotenv
 load_dotenv()  # This loads the .env file at the project root
 
@@ -22,14 +27,36 @@ load_dotenv()  # This loads the .env file at the project root
 app = Flask(__name__)
 app.config.from_object(app_config)
 Session(app)
+static_assets.init_app(app)  # Fingerprinted /assets and the static_url() template helper
 
 # Initialize the Cosmos DB client
-client = CosmosClient(app_config.ACCOUNT_HOST, credential=app_config.ACCOUNT_KEY)
+# The SDK's own 429 retries are switched off, CosmosAccess retries them within its budget (see cosmos_access.py)
+connection_policy = documents.ConnectionPolicy()
+connection_policy.RetryOptions = documents.RetryOptions(max_retry_attempt_count=0)
+client = CosmosClient(app_config.ACCOUNT_HOST, credential=app_config.ACCOUNT_KEY, connection_policy=connection_policy)
 database = client.get_database_client(app_config.COSMOS_DATABASE)
 container = database.get_container_client(app_config.COSMOS_CONTAINER)
+cosmos = CosmosAccess(
+    container,
+    ru_per_second=app_config.COSMOS_RU_PER_SECOND,
+    near_capacity_ratio=app_config.COSMOS_NEAR_CAPACITY_RATIO,
+    retry_budget=app_config.COSMOS_RETRY_BUDGET,
+    max_retries=app_config.COSMOS_MAX_RETRIES)
+cosmos.init_app(app)
 
 stripe.api_key = app_config.STRIPE_KEY
 
+# Admission control in front of Azure OpenAI, see admission.py
+# Each worker process gets its share of the deployment-wide limits. The queue only
+# comes into play with threaded workers (gunicorn --threads), see the README.
+llm_admission = AdmissionController(
+    max_concurrency=max(1, app_config.LLM_MAX_CONCURRENCY // app_config.LLM_WORKERS),
+    rate_per_user=app_config.LLM_USER_RATE / app_config.LLM_WORKERS,
+    burst_per_user=max(1, app_config.LLM_USER_BURST // app_config.LLM_WORKERS),
+    max_queue_per_user=app_config.LLM_MAX_QUEUE_PER_USER,
+    max_queue_total=app_config.LLM_MAX_QUEUE_TOTAL,
+    max_wait=app_config.LLM_MAX_WAIT)
+
 # This section is needed for url_for("foo", _external=True) to automatically
 # generate http scheme when this sample is running on localhost,
 # and to generate https scheme when it is deployed behind reversed proxy.
@@ -170,25 +197,40 @@ def get_user_sub():
     else:
         return 'default'
 
-def query_container(query, parameters):
+def is_admin():
+    '''Returns True if the signed in user is listed in app_config.ADMIN_USERS.'''
+    return get_user_sub() in app_config.ADMIN_USERS
+
+def query_container(query, parameters, operation='query'):
+    # Throttling past the retry budget raises CosmosThrottled (rendered as 503) rather than returning an empty result
     try:
-        return list(container.query_items(
-            query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True
-        ))
+        return cosmos.query_items(operation, query, parameters)
     except exceptions.CosmosHttpResponseError:
         return {}
 
 def load_company_profile(doc_id):
-    items = query_container("SELECT * FROM c WHERE c.id = @id", [{"name": "@id", "value": doc_id}])  
+    items = query_container("SELECT * FROM c WHERE c.id = @id", [{"name": "@id", "value": doc_id}], operation='load_company_profile')  
     return items[0] if items else {}
 
-def save_document(document):
+def save_document(document, priority=PRIORITY_HIGH):
+    '''Returns False if the document was not saved. Low priority writes are skipped while Cosmos DB is near its throughput.'''
     try:
-        container.upsert_item(document)
+        return cosmos.upsert_item('save_document', document, priority=priority)
     except exceptions.CosmosHttpResponseError as e:
         print(f'An error occurred: {e}')
+        return False
+
+@app.errorhandler(CosmosThrottled)
+def cosmos_throttled(e):
+    # Also makes Stripe retry the webhook later instead of losing the update
+    return "The service is busy, please try again shortly.", 503, {'Retry-After': str(e.retry_after)}
+
+@app.route("/admin/cosmos")
+def cosmos_stats():
+    '''Request charge (RU) per operation and per endpoint.'''
+    if not is_admin():
+        return "Not found", 404
+    return jsonify(cosmos.stats())
 
 @app.route("/company_profile/view")
 def view_company_profile():
@@ -216,8 +258,9 @@ def view_company_profile():
             update_required = True
 
     # Save updates if any field was initialized
+    # Low priority: the defaults are shown either way, and a skipped write is done again on the next visit
     if update_required:
-        save_document(company_profile)
+        save_document(company_profile, priority=PRIORITY_LOW)
 
     return render_template("view_company_profile.html", profile=company_profile, user=user)
 
@@ -253,15 +296,16 @@ def edit_company_profile():
 def load_job_profiles():
     user_id=get_user_sub()
     doc_id = user_id + '_job'
-    items = query_container("SELECT * FROM c WHERE c.id = @id", [{"name": "@id", "value": doc_id}])
+    items = query_container("SELECT * FROM c WHERE c.id = @id", [{"name": "@id", "value": doc_id}], operation='load_job_profiles')
     #if item is empty, initialize the job profile
+    #Low priority: an empty document is written again on the next load if skipped
     if not items:
         job_profiles_doc_initialize = {
             'id': doc_id,
             'user_id':user_id,
             'job_profiles': []
         }
-        save_document(job_profiles_doc_initialize)
+        save_document(job_profiles_doc_initialize, priority=PRIORITY_LOW)
         return job_profiles_doc_initialize
     return items[0]
 
@@ -409,7 +453,11 @@ def clone_job_profile(job_id):
 #JOB AD
 #*******************************
 
-def call_azure_open_ai(job_profile_description):
+class JobAdGenerationFailed(Exception):
+    '''Raised when the model returns no usable job ad, e.g. every completion was stopped by the content filter.'''
+
+def call_azure_open_ai(job_profile_description, n=1):
+    '''Returns a list of up to n generated ads. All n completions come from one call, so the prompt tokens are only sent once.'''
     openai.api_key = os.getenv("AZURE_OPENAI_KEY")
     openai.api_base = os.getenv("AZURE_OPENAI_ENDPOINT") # your endpoint should look like the following https://YOUR_RESOURCE_NAME.openai.azure.com/
     openai.api_type = 'azure'
@@ -423,22 +471,30 @@ def call_azure_open_ai(job_profile_description):
                      ]
 
     # Make a POST request to Azure OpenAI's GPT model with the job profile description
-    response = openai.ChatCompletion.create(
-        engine=deployment_name,
-        messages=message_text,
-        temperature=0.7,
-        max_tokens=200,
-        top_p=0.95,
-        frequency_penalty=0,
-        presence_penalty=0,
-        stop=None
-        # stop=["\n", "Human:", "AI:"]
-    )
-
-    generated_ad = response.get("choices")[0]['message']['content']
-    return generated_ad
-
-def generate_job_ad(profile,company_profile):
+    # Admission control raises AdmissionRejected (rendered as 429) if the user or the worker is over its limits
+    with llm_admission.admit(get_user_sub()):
+        response = openai.ChatCompletion.create(
+            engine=deployment_name,
+            messages=message_text,
+            temperature=0.7,
+            max_tokens=200,
+            top_p=0.95,
+            frequency_penalty=0,
+            presence_penalty=0,
+            n=n,
+            stop=None
+            # stop=["\n", "Human:", "AI:"]
+        )
+
+    # Completions stopped by the content filter have no content, skip them
+    generated_ads = [choice['message'].get('content') for choice in response.get("choices")]
+    generated_ads = [ad for ad in generated_ads if ad]
+    if not generated_ads:
+        raise JobAdGenerationFailed("No job ad was generated")
+    return generated_ads
+
+def generate_job_ad(profile,company_profile,n=1):
+    '''Returns a list of n alternative job ads for the profile.'''
     job_profile_description = f"""
     Based on the job profile and company profile provided after ===, generate job advertisement in plain text. Only show the generated job advertisement in your answer.
     Part 1, Top Selling Points. Top 3 selling point or benefits of the company (if remote or hybrid is mentioned, display it as a selling point)
@@ -460,7 +516,35 @@ def generate_job_ad(profile,company_profile):
     Employee benefits to offer: { company_profile.get('CompanyQ3', '') }
     Top 3 reasons people should work for the company? { company_profile.get('CompanyQ4', '') }
     """
-    return call_azure_open_ai(job_profile_description)
+    return call_azure_open_ai(job_profile_description, n=n)
+
+def save_generated_ad_variants(profile, ad_variants):
+    '''Stores the alternatives on the profile and makes the first one the current ad.'''
+    profile['ad_variants'] = ad_variants
+    profile['ad_variant_index'] = 0
+    profile['generated_ad'] = ad_variants[0]
+
+def job_ad_variant_context(profile):
+    '''Template variables for cycling through the stored ad alternatives on job_ad.html.'''
+    return {'ad_variants': profile.get('ad_variants', []), 'variant_index': profile.get('ad_variant_index', 0)}
+
+
+@app.errorhandler(AdmissionRejected)
+def llm_admission_rejected(e):
+    # Nothing has been saved at this point, so the user can simply retry
+    message = f"We are generating a lot of job ads right now, please try again in {e.retry_after} seconds."
+    return message, 429, {'Retry-After': str(e.retry_after)}
+
+@app.errorhandler(JobAdGenerationFailed)
+def job_ad_generation_failed(e):
+    return "We could not generate a job ad from this job profile. Please review the job profile and try again.", 502
+
+@app.route("/admin/admission")
+def admission_stats():
+    '''Queue depth and wait time of the OpenAI admission control, for sizing the deployment.'''
+    if not is_admin():
+        return "Not found", 404
+    return jsonify(llm_admission.stats())
 
 
 @app.route("/create_job_ad/regenerate/<int:job_id>")
@@ -475,15 +559,37 @@ def regenerate_job_ad(job_id):
         return "Job profile not found", 404
     if profile['alow_ad_generation'] == False:
         html_content = profile['generated_ad'].replace("\n", "<br>")
-        return render_template("job_ad.html", job_ad=html_content, job_id=job_id, user=session["user"])
+        return render_template("job_ad.html", job_ad=html_content, job_id=job_id, user=session["user"], **job_ad_variant_context(profile))
     else:
-        generated_ad = generate_job_ad(profile,company_profile)
-        profile['generated_ad'] = generated_ad
+        ad_variants = generate_job_ad(profile,company_profile,n=app_config.JOB_AD_VARIANTS)
+        save_generated_ad_variants(profile, ad_variants)
       
         profile['alow_ad_generation'] = False
         save_document(job_profiles_doc)
-        html_content = generated_ad.replace("\n", "<br>")
-        return render_template("job_ad.html", job_ad=html_content, job_id=job_id, user=session["user"])
+        html_content = profile['generated_ad'].replace("\n", "<br>")
+        return render_template("job_ad.html", job_ad=html_content, job_id=job_id, user=session["user"], **job_ad_variant_context(profile))
+
+
+@app.route("/create_job_ad/variant/<int:job_id>/<int:variant_index>")
+def select_job_ad_variant(job_id, variant_index):
+    '''Switches the job ad to one of the stored alternatives, without calling the model again.'''
+    job_profiles_doc = load_job_profiles()
+    job_profiles = job_profiles_doc['job_profiles']
+    profile = next((p for p in job_profiles if p["job_id"] == job_id), None)
+
+    if not profile:
+        return "Job profile not found", 404
+    ad_variants = profile.get('ad_variants', [])
+    if not 0 <= variant_index < len(ad_variants):
+        return "Job ad version not found", 404
+
+    profile['ad_variant_index'] = variant_index
+    profile['generated_ad'] = ad_variants[variant_index]
+    save_document(job_profiles_doc)
+
+    profile_updated_indicator = 1 if profile['alow_ad_generation'] == True else 0
+    html_content = profile['generated_ad'].replace("\n", "<br>")
+    return render_template("job_ad.html", job_ad=html_content, job_id=job_id, profile_updated_indicator=profile_updated_indicator, user=session["user"], **job_ad_variant_context(profile))
 
 
 @app.route("/create_job_ad/<int:job_id>")
@@ -510,16 +616,16 @@ def create_job_ad(job_id):
 
     # Check if 'generated_ad' is empty, if yes, generate the job ad
     if profile['generated_ad'] == '':
-        generated_ad = generate_job_ad(profile,company_profile)
-        profile['generated_ad'] = generated_ad
+        ad_variants = generate_job_ad(profile,company_profile,n=app_config.JOB_AD_VARIANTS)
+        save_generated_ad_variants(profile, ad_variants)
         profile['alow_ad_generation'] = False
         save_document(job_profiles_doc)
-        html_content = generated_ad.replace("\n", "<br>")
+        html_content = profile['generated_ad'].replace("\n", "<br>")
     
     else:
         html_content = profile['generated_ad'].replace("\n", "<br>")
     
-    return render_template("job_ad.html", job_ad=html_content, job_id=job_id,profile_updated_indicator=profile_updated_indicator, user=session["user"])
+    return render_template("job_ad.html", job_ad=html_content, job_id=job_id,profile_updated_indicator=profile_updated_indicator, user=session["user"], **job_ad_variant_context(profile))
 
 @app.route("/edit_job_ad/<int:job_id>", methods=["GET", "POST"])
 def edit_job_ad(job_id):
@@ -539,6 +645,10 @@ def edit_job_ad(job_id):
     if request.method == "POST":
         # Update the 'generated_ad' in the profile with the new content from the form
         profile['generated_ad'] = request.form['generated_ad_content']
+        # Keep the edit in the version being shown, so cycling through the versions does not lose it
+        ad_variants = profile.get('ad_variants', [])
+        if 0 <= profile.get('ad_variant_index', 0) < len(ad_variants):
+            ad_variants[profile.get('ad_variant_index', 0)] = profile['generated_ad']
 
         # Save the updated profiles back to your storage
         save_document(job_profiles_doc)
@@ -546,7 +656,7 @@ def edit_job_ad(job_id):
         edited_ad= copy.deepcopy(profile['generated_ad'])
         html_content = edited_ad.replace("\n", "<br>")
         # Redirect to the view page or somewhere else after saving
-        return render_template("job_ad.html", job_ad=html_content, job_id=job_id, profile_updated_indicator=profile_updated_indicator, user=user)
+        return render_template("job_ad.html", job_ad=html_content, job_id=job_id, profile_updated_indicator=profile_updated_indicator, user=user, **job_ad_variant_context(profile))
 
     return render_template("edit_job_ad.html", profile=profile, user=user)
 
@@ -703,6 +813,32 @@ def cancel_order():
     # Here you can add any logic you might need to handle a canceled order
     return render_template('stripe_cancel.html')  # Render a cancel page or message
 
+#*******************************
+#PROFILING
+#*******************************
+# Opt-in sampling profiler, see profiling.py. Admins can profile a request by sending the X-Profile: 1 header.
+profiler = RequestProfiler(
+    app_config.PROFILE_DIR,
+    sample_rate=app_config.PROFILE_SAMPLE_RATE,
+    slow_threshold=app_config.PROFILE_SLOW_THRESHOLD,
+    interval=app_config.PROFILE_INTERVAL,
+    max_files=app_config.PROFILE_MAX_FILES)
+if app_config.PROFILING_ENABLED:
+    profiler.init_app(app, is_admin)
+
+@app.route("/admin/profiles")
+def list_profiles():
+    '''Collapsed stack profiles (flame graph input), newest first.'''
+    if not is_admin():
+        return "Not found", 404
+    return jsonify([url_for('download_profile', filename=name) for name in profiler.list_profiles()])
+
+@app.route("/admin/profiles/<path:filename>")
+def download_profile(filename):
+    if not is_admin():
+        return "Not found", 404
+    return send_from_directory(app_config.PROFILE_DIR, filename, mimetype='text/plain')
+
 app.jinja_env.globals.update(_build_auth_code_flow=_build_auth_code_flow)  # Used in template
 
 if __name__ == "__main__":
@@ -40,4 +40,35 @@ COSMOS_CONTAINER = 'Profiles'
 
 STRIPE_KEY=os.getenv("STRIPE_KEY")
 
-MY_DOMAIN=os.getenv("MY_DOMAIN")
\ No newline at end of file
+MY_DOMAIN=os.getenv("MY_DOMAIN")
+
+# Comma separated list of user sub IDs allowed to use the /admin endpoints
+ADMIN_USERS = [sub.strip() for sub in os.getenv("ADMIN_USERS", "").split(",") if sub.strip()]
+
+# Admission control for the Azure OpenAI calls
+# The limits below are for the whole deployment. They are split evenly across the
+# worker processes (app.py), as each worker keeps its own state, see the README.
+LLM_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))  # Number of gunicorn worker processes
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))  # OpenAI calls in flight
+LLM_USER_RATE = float(os.getenv("LLM_USER_RATE", "0.1"))  # Sustained calls per second per user
+LLM_USER_BURST = int(os.getenv("LLM_USER_BURST", "5"))  # Calls a user can make back to back
+LLM_MAX_QUEUE_PER_USER = int(os.getenv("LLM_MAX_QUEUE_PER_USER", "2"))
+LLM_MAX_QUEUE_TOTAL = int(os.getenv("LLM_MAX_QUEUE_TOTAL", "16"))
+LLM_MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", "20"))  # Seconds a request may wait for a slot
+
+# Number of alternative job ads generated per OpenAI call, the user can cycle through them on the job ad page
+JOB_AD_VARIANTS = int(os.getenv("JOB_AD_VARIANTS", "3"))
+
+# Cosmos DB throttling (see cosmos_access.py, numbers are per worker process)
+COSMOS_RU_PER_SECOND = int(os.getenv("COSMOS_RU_PER_SECOND", "0"))  # Share of the provisioned RU/s, 0 to only react to 429s
+COSMOS_NEAR_CAPACITY_RATIO = float(os.getenv("COSMOS_NEAR_CAPACITY_RATIO", "0.8"))  # Low priority writes are skipped above this
+COSMOS_RETRY_BUDGET = float(os.getenv("COSMOS_RETRY_BUDGET", "5"))  # Seconds an operation may spend waiting on 429 retries
+COSMOS_MAX_RETRIES = int(os.getenv("COSMOS_MAX_RETRIES", "5"))
+
+# Request profiling (see profiling.py)
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # Fraction of requests to profile
+PROFILE_SLOW_THRESHOLD = float(os.getenv("PROFILE_SLOW_THRESHOLD", "2"))  # Seconds, 0 to disable slow request capture
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))  # Seconds between stack samples
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "100"))
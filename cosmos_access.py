@@ -0,0 +1,183 @@
+'''
+Throttle-aware access to the Cosmos DB container.
+
+CosmosAccess wraps the container client and
+- records the request charge (RU) of every call, per operation and per
+  Flask request (endpoint),
+- retries 429 (request rate too large) and 449 (retry with) responses after
+  the wait the server asks for in x-ms-retry-after-ms, within a bounded time
+  and retry budget, then raises CosmosThrottled so the caller fails loudly
+  instead of showing an empty profile or losing a write,
+- sheds low priority writes (e.g. filling in default fields) while the
+  container is near its throughput, i.e. when the RU used in the last second
+  is close to ru_per_second or a 429 was seen recently. Shed writes are
+  simply done again on a later request.
+
+The SDK's own throttle retries should be switched off (see app.py), otherwise
+they run before this budget applies. Numbers are per worker process.
+'''
+import threading
+import time
+from collections import deque
+
+from azure.cosmos import exceptions
+from flask import g, has_request_context, request
+
+PRIORITY_HIGH = 'high'
+PRIORITY_LOW = 'low'
+
+THROTTLE_STATUS_CODES = (429, 449)
+DEFAULT_RETRY_AFTER = 0.1  # Seconds, used when the server does not send x-ms-retry-after-ms
+
+
+class CosmosThrottled(Exception):
+    '''Raised when Cosmos keeps throttling past the retry budget. retry_after is in seconds.'''
+    def __init__(self, operation, retry_after):
+        super().__init__(f'Cosmos DB throttled {operation}')
+        self.operation = operation
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+class CosmosAccess:
+    def __init__(self, container, ru_per_second=0, near_capacity_ratio=0.8,
+                 retry_budget=5.0, max_retries=5, throttle_cooldown=5.0):
+        self.container = container
+        self.ru_per_second = ru_per_second  # 0 means unknown, only recent 429s count as near capacity
+        self.near_capacity_ratio = near_capacity_ratio
+        self.retry_budget = retry_budget  # Seconds spent waiting on retries per operation
+        self.max_retries = max_retries
+        self.throttle_cooldown = throttle_cooldown  # Seconds after a 429 during which low priority work is shed
+
+        self._lock = threading.Lock()
+        self._recent_charges = deque()  # (timestamp, charge) over the last second
+        self._last_throttled_at = None
+        self._operations = {}
+        self._endpoints = {}
+
+    def init_app(self, app):
+        '''Records the total request charge of each Flask request against its endpoint.'''
+        @app.after_request
+        def record_cosmos_request_charge(response):
+            if 'cosmos_request_charge' in g:
+                self._record_endpoint(request.endpoint, g.cosmos_request_charge)
+            return response
+
+    def query_items(self, operation, query, parameters):
+        def call(response_hook):
+            return list(self.container.query_items(
+                query=query,
+                parameters=parameters,
+                enable_cross_partition_query=True,
+                response_hook=response_hook
+            ))
+        return self._execute(operation, call, self.max_retries)
+
+    def upsert_item(self, operation, document, priority=PRIORITY_HIGH):
+        '''Upserts the document. Returns False if a low priority write was shed.'''
+        def call(response_hook):
+            return self.container.upsert_item(document, response_hook=response_hook)
+
+        if priority == PRIORITY_HIGH:
+            self._execute(operation, call, self.max_retries)
+            return True
+
+        if self.near_capacity():
+            self._bump(operation, 'shed')
+            return False
+        try:
+            # Low priority work is not worth waiting for, give up on the first 429
+            self._execute(operation, call, 0)
+        except CosmosThrottled:
+            self._bump(operation, 'shed')
+            return False
+        return True
+
+    def near_capacity(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._last_throttled_at is not None and now - self._last_throttled_at < self.throttle_cooldown:
+                return True
+            if not self.ru_per_second:
+                return False
+            self._expire_charges(now)
+            used = sum(charge for _, charge in self._recent_charges)
+            return used >= self.ru_per_second * self.near_capacity_ratio
+
+    def _execute(self, operation, call, max_retries):
+        deadline = time.monotonic() + self.retry_budget
+        retries = 0
+        while True:
+            charges = []
+
+            def response_hook(headers, *args):
+                charges.append(float(headers.get('x-ms-request-charge') or 0))
+
+            try:
+                result = call(response_hook)
+                self._record_charge(operation, sum(charges))
+                return result
+            except exceptions.CosmosHttpResponseError as e:
+                headers = e.headers or {}
+                self._record_charge(operation, sum(charges) + float(headers.get('x-ms-request-charge') or 0))
+                if e.status_code not in THROTTLE_STATUS_CODES:
+                    raise
+                retry_after = float(headers.get('x-ms-retry-after-ms') or 0) / 1000 or DEFAULT_RETRY_AFTER
+                self._record_throttled(operation)
+                if retries >= max_retries or time.monotonic() + retry_after > deadline:
+                    raise CosmosThrottled(operation, retry_after)
+                retries += 1
+                self._bump(operation, 'retries')
+                time.sleep(retry_after)
+
+    def _operation_stats(self, operation):
+        with self._lock:
+            stats = self._operations.get(operation)
+            if stats is None:
+                stats = self._operations[operation] = {
+                    'count': 0, 'ru_total': 0.0, 'ru_max': 0.0, 'throttled': 0, 'retries': 0, 'shed': 0}
+            return stats
+
+    def _bump(self, operation, key):
+        stats = self._operation_stats(operation)
+        with self._lock:
+            stats[key] += 1
+
+    def _record_charge(self, operation, charge):
+        stats = self._operation_stats(operation)
+        now = time.monotonic()
+        with self._lock:
+            stats['count'] += 1
+            stats['ru_total'] += charge
+            stats['ru_max'] = max(stats['ru_max'], charge)
+            self._recent_charges.append((now, charge))
+            self._expire_charges(now)
+        if has_request_context():
+            g.cosmos_request_charge = g.get('cosmos_request_charge', 0.0) + charge
+
+    def _record_throttled(self, operation):
+        stats = self._operation_stats(operation)
+        with self._lock:
+            stats['throttled'] += 1
+            self._last_throttled_at = time.monotonic()
+
+    def _record_endpoint(self, endpoint, charge):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {'requests': 0, 'ru_total': 0.0, 'ru_max': 0.0})
+            stats['requests'] += 1
+            stats['ru_total'] += charge
+            stats['ru_max'] = max(stats['ru_max'], charge)
+
+    def _expire_charges(self, now):
+        while self._recent_charges and now - self._recent_charges[0][0] > 1:
+            self._recent_charges.popleft()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            self._expire_charges(now)
+            return {
+                'ru_last_second': sum(charge for _, charge in self._recent_charges),
+                'ru_per_second': self.ru_per_second,
+                'operations': {name: dict(stats) for name, stats in self._operations.items()},
+                'endpoints': {str(name): dict(stats) for name, stats in self._endpoints.items()},
+            }
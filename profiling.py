@@ -0,0 +1,150 @@
+'''
+On-demand sampling profiler for Flask requests.
+
+A request is profiled when
+- an admin sends the X-Profile: 1 header,
+- it is picked by the random sample rate, or
+- it runs longer than the slow request threshold (samples are taken from
+  the moment it crosses the threshold).
+
+One background thread wakes up every interval and records the current stack
+of each thread serving a profiled request (sys._current_frames()). When the
+request ends its samples are written to output_dir in the collapsed stack
+format ("frame;frame;frame count" per line), which flamegraph.pl, speedscope
+and most flame graph viewers read directly. Responses to sampled or X-Profile
+requests carry X-Profile-Samples (0 if the request finished before the first
+sample) and X-Profile-File with the name of the written profile.
+
+When no request is being profiled the cost is a dict insert and delete per
+request and a thread waking up every interval, so it can stay on in production.
+'''
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import request
+
+PROFILE_FILE_SUFFIX = '.folded'
+
+
+class _ActiveRequest:
+    __slots__ = ('started_at', 'profiled', 'samples')
+
+    def __init__(self, profiled):
+        self.started_at = time.monotonic()
+        self.profiled = profiled
+        self.samples = Counter()
+
+
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':'))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class RequestProfiler:
+    def __init__(self, output_dir, sample_rate=0.0, slow_threshold=0.0, interval=0.01, max_files=100):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate  # Fraction of requests to profile, 0 to disable
+        self.slow_threshold = slow_threshold  # Seconds, 0 to disable slow request capture
+        self.interval = interval  # Seconds between stack samples
+        self.max_files = max_files  # Oldest profiles are deleted beyond this
+
+        self._is_admin = None
+        self._lock = threading.Lock()
+        self._active = {}  # thread id -> _ActiveRequest
+        self._sampler = None
+
+    def init_app(self, app, is_admin):
+        '''is_admin() decides whether the X-Profile header is honoured for the current user.'''
+        self._is_admin = is_admin
+        os.makedirs(self.output_dir, exist_ok=True)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_profiled_request)
+        app.teardown_request(self._finish_request)
+
+    def _start_request(self):
+        # Started lazily so the thread exists in each worker, not only in a preloading master process
+        if self._sampler is None:
+            with self._lock:
+                if self._sampler is None:
+                    self._sampler = threading.Thread(target=self._sample_forever, name='request-profiler', daemon=True)
+                    self._sampler.start()
+
+        profiled = ((self.sample_rate and random.random() < self.sample_rate)
+                    or (request.headers.get('X-Profile') == '1' and self._is_admin()))
+        with self._lock:
+            self._active[threading.get_ident()] = _ActiveRequest(bool(profiled))
+
+    def _finish_profiled_request(self, response):
+        # Sampled and X-Profile requests are finished here, so the response can
+        # report what was captured. Everything else is finished on teardown.
+        with self._lock:
+            active = self._active.get(threading.get_ident())
+            if active is None or not active.profiled:
+                return response
+            del self._active[threading.get_ident()]
+        response.headers['X-Profile-Samples'] = str(sum(active.samples.values()))
+        if active.samples:
+            response.headers['X-Profile-File'] = self._save(active)
+        return response
+
+    def _finish_request(self, exc=None):
+        with self._lock:
+            active = self._active.pop(threading.get_ident(), None)
+        if active is not None and active.samples:
+            self._save(active)
+
+    def _save(self, active):
+        elapsed_ms = int((time.monotonic() - active.started_at) * 1000)
+        reason = 'sampled' if active.profiled else 'slow'
+        return self._write_profile(f'{request.endpoint}_{elapsed_ms}ms_{reason}', active.samples)
+
+    def _sample_forever(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self._lock:
+                targets = [(thread_id, active) for thread_id, active in self._active.items()
+                           if active.profiled or (self.slow_threshold and now - active.started_at >= self.slow_threshold)]
+            if not targets:
+                continue
+            frames = sys._current_frames()
+            stacks = [(thread_id, active, _collapse(frames[thread_id]))
+                      for thread_id, active in targets if thread_id in frames]
+            del frames
+            with self._lock:
+                for thread_id, active, stack in stacks:
+                    # The request may have finished while its stack was collapsed
+                    if self._active.get(thread_id) is active:
+                        active.samples[stack] += 1
+
+    def _write_profile(self, label, samples):
+        '''Writes the samples to output_dir and returns the file name.'''
+        timestamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        name = f'{timestamp}_{label}{PROFILE_FILE_SUFFIX}'
+        path = os.path.join(self.output_dir, name)
+        with open(path, 'w') as f:
+            for stack, count in samples.items():
+                f.write(f'{stack} {count}\n')
+        for old_name in self.list_profiles()[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.output_dir, old_name))
+            except OSError:  # Already removed by another worker
+                pass
+        return name
+
+    def list_profiles(self):
+        '''Profile file names, newest first.'''
+        try:
+            names = [name for name in os.listdir(self.output_dir) if name.endswith(PROFILE_FILE_SUFFIX)]
+        except OSError:
+            return []
+        return sorted(names, reverse=True)
@@ -0,0 +1,119 @@
+'''
+Build and serve fingerprinted static assets.
+
+Build step (run at deploy time, see the GitHub workflow):
+    python static_assets.py
+copies every file under static/ to static_build/ with a content hash in its
+name (styles.css -> styles.1a2b3c4d5e.css), writes pre-compressed .gz and
+.br variants next to it and records the mapping in static_build/manifest.json.
+
+At runtime templates call static_url('styles.css'), which resolves the name
+through the manifest to /assets/styles.1a2b3c4d5e.css. Because the URL changes
+whenever the content does, those responses are cached by the browser (and any
+CDN in front of the app) for a year as immutable, so repeat visitors do not
+download static bytes again. If the build step has not been run, static_url()
+falls back to the plain /static URL.
+'''
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional, browsers still get the gzip variant
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(BASE_DIR, 'static')
+BUILD_DIR = os.path.join(BASE_DIR, 'static_build')
+MANIFEST_PATH = os.path.join(BUILD_DIR, 'manifest.json')
+
+# Already compressed formats gain nothing from gzip/brotli
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.html', '.txt', '.json', '.map', '.ico'}
+
+CACHE_CONTROL_IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Preferred encodings first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+def build(source_dir=SOURCE_DIR, build_dir=BUILD_DIR):
+    '''Builds fingerprinted and pre-compressed copies of source_dir into build_dir. Returns the manifest.'''
+    if os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    manifest = {}
+    for root, _, files in os.walk(source_dir):
+        for name in files:
+            source_path = os.path.join(root, name)
+            logical_name = os.path.relpath(source_path, source_dir).replace(os.sep, '/')
+            with open(source_path, 'rb') as f:
+                content = f.read()
+
+            stem, ext = os.path.splitext(logical_name)
+            digest = hashlib.sha256(content).hexdigest()[:10]
+            fingerprinted_name = f'{stem}.{digest}{ext}'
+            target_path = os.path.join(build_dir, fingerprinted_name)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with open(target_path, 'wb') as f:
+                f.write(content)
+
+            if ext.lower() in COMPRESSIBLE_EXTENSIONS:
+                # mtime=0 keeps the gzip output identical between builds
+                with open(target_path + '.gz', 'wb') as f:
+                    f.write(gzip.compress(content, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target_path + '.br', 'wb') as f:
+                        f.write(brotli.compress(content, quality=11))
+
+            manifest[logical_name] = fingerprinted_name
+
+    with open(os.path.join(build_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(manifest_path=MANIFEST_PATH):
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def init_app(app):
+    '''Registers the /assets route and the static_url() template helper.'''
+    manifest = load_manifest()
+
+    def static_url(filename):
+        fingerprinted_name = manifest.get(filename)
+        if fingerprinted_name is None:
+            return url_for('static', filename=filename)
+        return url_for('fingerprinted_asset', filename=fingerprinted_name)
+
+    @app.route('/assets/<path:filename>')
+    def fingerprinted_asset(filename):
+        # send_from_directory hands the file to the server's wsgi.file_wrapper
+        # (sendfile), so the worker does not stream the bytes itself
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        for encoding, suffix in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(os.path.join(BUILD_DIR, filename + suffix)):
+                response = send_from_directory(BUILD_DIR, filename + suffix, mimetype=mimetype)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(BUILD_DIR, filename, mimetype=mimetype)
+        response.headers['Cache-Control'] = CACHE_CONTROL_IMMUTABLE
+        response.vary.add('Accept-Encoding')
+        return response
+
+    app.jinja_env.globals.update(static_url=static_url)  # Used in templates
+
+
+if __name__ == '__main__':
+    for logical_name, fingerprinted_name in sorted(build().items()):
+        print(f'{logical_name} -> {fingerprinted_name}')